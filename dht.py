@@ -22,15 +22,17 @@
 # SOFTWARE.
 
 import Adafruit_DHT
-import numpy as np
 import socket
 import sys
 import argparse
 import time
-from datetime import datetime
+import atexit
+import signal
 
 from influxdb import InfluxDBClient
 
+from sensors_common import weather_readings, add_influx_arguments, parse_tags, build_series, batch_writer, describe_readings, write_output, time_ns
+
 
 # Sensor should be set to Adafruit_DHT.DHT11,
 # Adafruit_DHT.DHT22, or Adafruit_DHT.AM2302.
@@ -40,22 +42,6 @@ sensor = Adafruit_DHT.DHT22
 # connected to GPIO23.
 pin = 4
 
-# dewpoint constants (see https://en.wikipedia.org/wiki/Dew_point)
-b = 17.27
-c = 237.7
-
-def gamma( Tc, RH ):
-    """ gamma function takes temperature in celcius and percent relative humidity """
-    return ( (np.log(RH/100.0)) + (b * Tc)/(c + Tc) )
-
-def dewpoint ( Tc, RH ):
-    """ calculate dewpoint in Celcius given temperature in celcius and relative humidity """
-    return ( ( c * gamma(Tc, RH)) / (b - gamma(Tc, RH)) )
-
-def CtoF ( Tc ):
-    """ return Temperature in Farenheit """
-    return ( (Tc * (9.0/5.0)) + 32.0 )
-
 def get_values():
     """
     Read the sensors available and their values  
@@ -67,74 +53,37 @@ def get_values():
     except e:
         return None
 
-    dewpointC = dewpoint ( temperatureC, humidity )
-    temperatureF = CtoF(temperatureC)
-    dewpointF = CtoF(dewpointC)
-    
-    d = {}
-    d['tempC'] = temperatureC
-    d['tempF'] = temperatureF
-    d['rh'] = humidity
-    d['dewC'] = dewpointC
-    d['dewF'] = dewpointF
-    
-    return d
+    return weather_readings(temperatureC, humidity)
 
 
 
 if __name__ == "__main__" :
 
     parser = argparse.ArgumentParser(description='DHT to influxdb service.')
-    parser.add_argument("--influx_server", dest='server', default='localhost', help='influxdb server')
-    parser.add_argument("--influx_port", dest='port', default=8086, help='influxdb server port number')
-    parser.add_argument("--influx_database", dest='db', default='pi_dht', help='influxdb database name')
-    parser.add_argument("--tags", dest='tags', default=None, help='influxdb tags in the form of name=value,name=value')
-    parser.add_argument("--interval", dest='interval', default=5, help='interval between readings in minutes')
+    add_influx_arguments(parser)
     hostname = socket.gethostname()
 
     args = parser.parse_args()
 
     print "Connecting to {0}:{1} and writing to database {2}".format(args.server, args.port, args.db)
-    client = InfluxDBClient(host=args.server, port=args.port, database=args.db)
-
-    tags = {'hostname': hostname}
-    if args.tags:
-        splits = args.tags.split(',')
-        for s in splits:
-            tag_split = s.split('=')
-            tags[tag_split[0]]=tag_split[1]
-        print "Found tags: {0}".format(repr(tags))
+    client = InfluxDBClient(host=args.server, port=args.port, database=args.db, gzip=True)
+    batcher = batch_writer(client, args)
+    atexit.register(batcher.flush)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    tags = parse_tags(hostname, args.tags)
     
     while True:
-        stamp = datetime.utcnow().isoformat()
+        stamp = time_ns()
 
         readings = get_values()
         if readings == None:
             sys.exit(-1);
 
-        print "Temp: {0}C {1}F, RH: {2}%, Dewpoint: {3}C {4}F".format( readings['tempC'], readings['tempF'], readings['rh'], readings['dewC'], readings['dewF'])
-
-        series = []
-        for measurement in ['temperature', 'humidity', 'dewpoint']:
-            fields = {}
-            if measurement == 'temperature':
-                fields["tempF"] = readings['tempF']
-                fields["tempC"] = readings['tempC']
-            elif measurement == 'humidity':
-                fields["rh"] = readings['rh']
-            elif measurement == 'dewpoint':
-                fields["dewF"] = readings["dewF"]
-                fields["dewC"] = readings["dewC"]
-                
-            d = { "measurement": measurement,
-                  "tags": tags,
-                  "time": stamp,
-                  "fields": fields
-                  }
-            series.append(d)
-
-        print repr(series)
-        client.write_points(series)
+        series = build_series(readings, tags, stamp)
+        batcher.append(series)
+
+        write_output([ describe_readings(readings), repr(series) ])
         time.sleep(int(args.interval)*60)
 
         
@@ -23,134 +23,186 @@
 
 import subprocess
 import json
-import numpy as np
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
 import socket
 import sys
 import argparse
 import time
-from datetime import datetime
+import atexit
+import signal
+import threading
 
 from influxdb import InfluxDBClient
 
-# dewpoint constants (see https://en.wikipedia.org/wiki/Dew_point)
-b = 17.27
-c = 237.7
+from sensors_common import weather_readings, add_influx_arguments, parse_tags, build_series, batch_writer, read_lines, stop_process, describe_readings, write_output, time_ns
 
-def gamma( Tc, RH ):
-    """ gamma function takes temperature in celcius and percent relative humidity """
-    return ( (np.log(RH/100.0)) + (b * Tc)/(c + Tc) )
 
-def dewpoint ( Tc, RH ):
-    """ calculate dewpoint in Celcius given temperature in celcius and relative humidity """
-    return ( ( c * gamma(Tc, RH)) / (b - gamma(Tc, RH)) )
+# rtl_433 is started once and kept running (or runs as its own service,
+# publishing to mqtt); its events keep the most recent humidity/temperature
+# pair in _latest for get_values
+rtl_433_command = ["rtl_433", "-f", "434078700", "-R", "34", "-F", "json"]
+_latest = {}
+_latest_cond = threading.Condition()
+_pending = {}
+_reader = None
+_process = None
+_process_lock = threading.Lock()
+_stopping = False
 
-def CtoF ( Tc ):
-    """ return Temperature in Farenheit """
-    return ( (Tc * (9.0/5.0)) + 32.0 )
-
-def get_values():
+def record_event( d ):
     """
-    Read the sensors available and their values  
-    Returns a dictionary with the readings or None on errors
+    Record the humidity/temperature values from one decoded rtl_433 event,
+    updating _latest once both have been seen
+    """
+    if 'humidity' in d:
+        _pending['rh'] = float(d['humidity'])
+    if 'temperature_C' in d:
+        _pending['tempC'] = float(d['temperature_C'])
+    if 'rh' in _pending and 'tempC' in _pending:
+        with _latest_cond:
+            _latest.update(_pending)
+            _latest['ts'] = time.time()
+            _latest_cond.notify_all()
+        _pending.clear()
+
+def read_rtl_433():
+    """
+    Run rtl_433 and record each humidity/temperature pair it reports in _latest.
+    rtl_433 is restarted if it exits, unless stop_rtl_433 has been called.
     """
+    global _process
 
-    command_line = ["rtl_433", "-f", "434078700", "-R", "34", "-F", "json"]
-    #command_line = ["cat", "values.txt"]
-    humidity = 0
-    temperatureC = 0
-    foundH = 0
-    foundT = 0
-    
-    p = subprocess.Popen(command_line, stdout=subprocess.PIPE)
-    while foundH == 0 or foundT == 0:
-        output = p.stdout.readline()
-        if output == '' and p.poll() is not None:
-            break
-        if output:
+    while True:
+        _pending.clear()
+
+        with _process_lock:
+            if _stopping:
+                return
+            try:
+                p = subprocess.Popen(rtl_433_command, stdout=subprocess.PIPE)
+            except OSError as e:
+                print "Failed to start rtl_433: {0}".format(e)
+                p = None
+            _process = p
+        if p is None:
+            time.sleep(60)
+            continue
+
+        for output in read_lines(p):
             try:
-                d = json.loads(output)
-                if 'humidity' in d:
-                    foundH = 1
-                    humidity = float(d['humidity'])
-                if 'temperature_C' in d:
-                    foundT = 1
-                    temperatureC = float(d['temperature_C'])
+                record_event(json.loads(output))
             except ValueError as e:
                 continue
+
+        p.wait()
+        _process = None
+        if _stopping:
+            return
+        print "rtl_433 exited with status {0}, restarting".format(p.returncode)
+        time.sleep(5)
+
+def stop_rtl_433():
+    """ stop the rtl_433 started by read_rtl_433, if it is running, and keep it from restarting """
+    global _stopping
+
+    with _process_lock:
+        _stopping = True
+        p = _process
+    if p is not None:
+        stop_process(p)
+
+def subscribe_rtl_433( server, port, topic ):
+    """
+    Record the rtl_433 events published to topic on an mqtt broker instead
+    of running rtl_433 here (see rtl_433.service)
+    """
+    global _reader
+
+    def on_connect( client, userdata, flags, rc ):
+        client.subscribe(topic)
+
+    def on_message( client, userdata, message ):
+        try:
+            record_event(json.loads(message.payload))
+        except ValueError as e:
+            pass
+
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
     else:
-        p.kill()
-    
-        dewpointC = dewpoint ( temperatureC, humidity )
-        temperatureF = CtoF(temperatureC)
-        dewpointF = CtoF(dewpointC)
-    
-        d = {}
-        d['tempC'] = temperatureC
-        d['tempF'] = temperatureF
-        d['rh'] = humidity
-        d['dewC'] = dewpointC
-        d['dewF'] = dewpointF
-    
-        return d
-    
-    return None
+        client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect_async(server, port)
+    client.loop_start()
+    _reader = client
+
+def get_values( max_age=600 ):
+    """
+    Read the sensors available and their values  
+    Returns a dictionary with the latest readings from rtl_433, waiting up to
+    max_age seconds for one, or None if none is newer than max_age seconds
+    or the reading is invalid
+    """
+    global _reader
+
+    with _latest_cond:
+        if _reader is None:
+            _reader = threading.Thread(target=read_rtl_433)
+            _reader.daemon = True
+            _reader.start()
+        if time.time() - _latest.get('ts', 0) >= max_age:
+            _latest_cond.wait(max_age)
+        if time.time() - _latest.get('ts', 0) >= max_age:
+            return None
+        humidity = _latest['rh']
+        temperatureC = _latest['tempC']
+
+    return weather_readings(temperatureC, humidity)
 
 
 
 if __name__ == "__main__" :
 
     parser = argparse.ArgumentParser(description='DHT to influxdb service.')
-    parser.add_argument("--influx_server", dest='server', default='localhost', help='influxdb server')
-    parser.add_argument("--influx_port", dest='port', default=8086, help='influxdb server port number')
-    parser.add_argument("--influx_database", dest='db', default='pi_dht', help='influxdb database name')
-    parser.add_argument("--tags", dest='tags', default=None, help='influxdb tags in the form of name=value,name=value')
-    parser.add_argument("--interval", dest='interval', default=5, help='interval between readings in minutes')
+    add_influx_arguments(parser)
+    parser.add_argument("--mqtt_server", dest='mqtt_server', default=None, help="read rtl_433 events from this mqtt broker instead of running rtl_433")
+    parser.add_argument("--mqtt_port", dest='mqtt_port', default=1883, help="mqtt broker port number")
+    parser.add_argument("--mqtt_topic", dest='mqtt_topic', default='rtl433/events', help="mqtt topic rtl_433 publishes events to")
     hostname = socket.gethostname()
 
     args = parser.parse_args()
 
+    if args.mqtt_server:
+        if mqtt is None:
+            parser.error("--mqtt_server needs the paho-mqtt package")
+        print "Reading rtl_433 events from {0}:{1} topic {2}".format(args.mqtt_server, args.mqtt_port, args.mqtt_topic)
+        subscribe_rtl_433(args.mqtt_server, int(args.mqtt_port), args.mqtt_topic)
+
     print "Connecting to {0}:{1} and writing to database {2}".format(args.server, args.port, args.db)
-    client = InfluxDBClient(host=args.server, port=args.port, database=args.db)
-
-    tags = {'hostname': hostname}
-    if args.tags:
-        splits = args.tags.split(',')
-        for s in splits:
-            tag_split = s.split('=')
-            tags[tag_split[0]]=tag_split[1]
-        print "Found tags: {0}".format(repr(tags))
+    client = InfluxDBClient(host=args.server, port=args.port, database=args.db, gzip=True)
+    batcher = batch_writer(client, args)
+    atexit.register(batcher.flush)
+    atexit.register(stop_rtl_433)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    tags = parse_tags(hostname, args.tags)
     
     while True:
-        stamp = datetime.utcnow().isoformat()
+        stamp = time_ns()
 
-        readings = get_values()
+        readings = get_values(int(args.interval)*120)
         if readings == None:
             time.sleep(int(args.interval)*60)
             continue
 
-        print "Temp: {0}C {1}F, RH: {2}%, Dewpoint: {3}C {4}F".format( readings['tempC'], readings['tempF'], readings['rh'], readings['dewC'], readings['dewF'])
-
-        series = []
-        for measurement in ['temperature', 'humidity', 'dewpoint']:
-            fields = {}
-            if measurement == 'temperature':
-                fields["tempF"] = readings['tempF']
-                fields["tempC"] = readings['tempC']
-            elif measurement == 'humidity':
-                fields["rh"] = readings['rh']
-            elif measurement == 'dewpoint':
-                fields["dewF"] = readings["dewF"]
-                fields["dewC"] = readings["dewC"]
-                
-            d = { "measurement": measurement,
-                  "tags": tags,
-                  "time": stamp,
-                  "fields": fields
-                  }
-            series.append(d)
-
-        print repr(series)
-        client.write_points(series)
+        series = build_series(readings, tags, stamp)
+        batcher.append(series)
+
+        write_output([ describe_readings(readings), repr(series) ])
         time.sleep(int(args.interval)*60)
 
         
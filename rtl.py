@@ -23,31 +23,18 @@
 
 import subprocess
 import json
-import numpy as np
 import socket
 import sys
 import argparse
 import time
-import pprint
-from datetime import datetime
+import atexit
+import signal
+import logging
 
 from influxdb import InfluxDBClient
 
-# dewpoint constants (see https://en.wikipedia.org/wiki/Dew_point)
-b = 17.27
-c = 237.7
+from sensors_common import weather_readings, add_influx_arguments, parse_tags, build_series, to_lineprotocol, batch_writer, read_lines, stop_process, describe_readings, write_output, time_ns
 
-def gamma( Tc, RH ):
-    """ gamma function takes temperature in celcius and percent relative humidity """
-    return ( (np.log(RH/100.0)) + (b * Tc)/(c + Tc) )
-
-def dewpoint ( Tc, RH ):
-    """ calculate dewpoint in Celcius given temperature in celcius and relative humidity """
-    return ( ( c * gamma(Tc, RH)) / (b - gamma(Tc, RH)) )
-
-def CtoF ( Tc ):
-    """ return Temperature in Farenheit """
-    return ( (Tc * (9.0/5.0)) + 32.0 )
 
 def get_values():
     """
@@ -63,151 +50,90 @@ def get_values():
     foundT = 0
     
     p = subprocess.Popen(command_line, stdout=subprocess.PIPE)
-    while foundH == 0 or foundT == 0:
-        output = p.stdout.readline()
-        if output == '' and p.poll() is not None:
+    for output in read_lines(p):
+        try:
+            d = json.loads(output)
+            if 'humidity' in d:
+                foundH = 1
+                humidity = float(d['humidity'])
+            if 'temperature_C' in d:
+                foundT = 1
+                temperatureC = float(d['temperature_C'])
+        except ValueError as e:
+            continue
+        if foundH and foundT:
             break
-        if output:
-            try:
-                d = json.loads(output)
-                if 'humidity' in d:
-                    foundH = 1
-                    humidity = float(d['humidity'])
-                if 'temperature_C' in d:
-                    foundT = 1
-                    temperatureC = float(d['temperature_C'])
-            except ValueError as e:
-                continue
-    else:
-        p.kill()
-    
-        dewpointC = dewpoint ( temperatureC, humidity )
-        temperatureF = CtoF(temperatureC)
-        dewpointF = CtoF(dewpointC)
-    
-        d = {}
-        d['tempC'] = temperatureC
-        d['tempF'] = temperatureF
-        d['rh'] = humidity
-        d['dewC'] = dewpointC
-        d['dewF'] = dewpointF
-    
-        return d
-    
-    return None
+    stop_process(p)
 
-def do_weather_reading( influxclient, timestamp, tags ):
+    if not (foundH and foundT):
+        # rtl_433 exited before reporting both values
+        return None
+
+    return weather_readings(temperatureC, humidity)
+
+def do_weather_reading( batcher, timestamp, tags ):
+    """ read the weather sensor and send to influx, returning the output lines to print """
 
     readings = get_values()
     if readings == None:
-        return
-    
-    print "Temp: {0}C {1}F, RH: {2}%, Dewpoint: {3}C {4}F".format( readings['tempC'], readings['tempF'], readings['rh'], readings['dewC'], readings['dewF'])
-
-    series = []
-    for measurement in ['temperature', 'humidity', 'dewpoint']:
-        fields = {}
-        if measurement == 'temperature':
-            fields["tempF"] = readings['tempF']
-            fields["tempC"] = readings['tempC']
-        elif measurement == 'humidity':
-            fields["rh"] = readings['rh']
-        elif measurement == 'dewpoint':
-            fields["dewF"] = readings["dewF"]
-            fields["dewC"] = readings["dewC"]
-                
-        d = { "measurement": measurement,
-              "tags": tags,
-              "time": timestamp,
-              "fields": fields
-        }
-        series.append(d)
-
-    pprint.pprint(series)
-    if influxclient:
-        influxclient.write_points(series)
+        return []
+
+    series = build_series(readings, tags, timestamp)
+
+    logging.debug("%s", series)
+    if batcher:
+        batcher.append(series)
+
+    return [ describe_readings(readings) ]
     
 
 class rtl:
 
-    def __init__ ( self, rtl_server_ip, rtl_port, electric_id=None, gas_id=None, water_id=None ):
+    def __init__ ( self, rtl_server_ip, rtl_port, electric_id=None, gas_id=None, water_id=None, base_tags=None ):
         self.rtl_server = rtl_server_ip
         self.rtl_port = rtl_port
         self.electric_meter_id = electric_id
         self.gas_meter_id = gas_id
         self.water_meter_id = water_id
 
-    def do_water_meter_reading( self, influxclient, timestamp, tags ):
-        " read water and send to influx "
+        # influx tags for each meter never change, so build them once
+        base_tags = base_tags or {}
+        self._gas_tags = dict(base_tags, meterid=gas_id, units="ccf", version=1)
+        self._electric_tags = dict(base_tags, meterid=electric_id, units="kwh", version=1)
+        self._water_tags = dict(base_tags, meterid=water_id, units="hcf", version=1)
 
-        reading = self.get_water_reading()
-        if reading == None:
-            return
-    
-        print "Water: {0} HCC ".format( reading )
+        # meter id -> reading name, for matching rtlamr messages
+        self._meter_kinds = {}
+        if gas_id:
+            self._meter_kinds[int(gas_id)] = "gas"
+        if electric_id:
+            self._meter_kinds[int(electric_id)] = "electric"
+        if water_id:
+            self._meter_kinds[int(water_id)] = "water"
 
-        series = []
-        fields = {}
-        fields["reading"] = reading
-        tags["meterid"] = self.water_meter_id
-        tags["units"] = "hcf"
-        tags["version"] = 1
-        
-        d = { "measurement": "water",
-              "tags": tags,
-              "time": timestamp,
-              "fields": fields
-        }
-        series.append(d)
-
-        pprint.pprint(series)
-        if influxclient:
-            influxclient.write_points(series)
-
-    def do_gas_electric_meter_reading( self, influxclient, timestamp, tags):
-        " read gas & electric and send to influx "
+    def do_meter_readings( self, batcher, timestamp, water=False ):
+        " read gas & electric (and water if requested) and send to influx, returning the output lines to print "
 
-        readings = self.get_gas_and_electric_reading()
+        readings = self.get_meter_readings(water)
 
         series = []
+        output = []
         
         if "gas" in readings:
-            print "Gas: {0} CCF ".format( readings["gas"] )
-
-            fields = {}
-            fields["reading"] = readings["gas"]
-            gas_tags = tags.copy()
-            gas_tags["meterid"] = self.gas_meter_id
-            gas_tags["units"] = "ccf"
-            gas_tags["version"] = 1
-                
-            d = { "measurement": "gas",
-                  "tags": gas_tags,
-                  "time": timestamp,
-                  "fields": fields
-            }
-            series.append(d)
+            output.append("Gas: {0} CCF ".format( readings["gas"] ))
+            series.append(to_lineprotocol("gas", self._gas_tags, { "reading": readings["gas"] }, timestamp))
         if "electric" in readings:
-            print "Electric: {0} KWH ".format( readings["electric"] )
-
-            fields = {}
-            fields["reading"] = readings["electric"]
-            etags = tags.copy()
-            etags["meterid"] = self.electric_meter_id
-            etags["units"] = "kwh"
-            etags["version"] = 1
-                        
-            d = { "measurement": "electric",
-                  "tags": etags,
-                  "time": timestamp,
-                  "fields": fields
-            }
-            series.append(d)
-        
+            output.append("Electric: {0} KWH ".format( readings["electric"] ))
+            series.append(to_lineprotocol("electric", self._electric_tags, { "reading": readings["electric"] }, timestamp))
+        if "water" in readings:
+            output.append("Water: {0} HCC ".format( readings["water"] ))
+            series.append(to_lineprotocol("water", self._water_tags, { "reading": readings["water"] }, timestamp))
+
+        logging.debug("%s", series)
+        if batcher:
+            batcher.append(series)
 
-        pprint.pprint(series)
-        if influxclient:
-            influxclient.write_points(series)
+        return output
 
         
         
@@ -221,26 +147,23 @@ class rtl:
 
         command_line = ["rtlamr", "-format", "json", "-msgtype", msgtype,
                         "-server", server, "-filterid", ids, "-single", "true"]
-        print " ".join(command_line)
+        logging.debug("%s", " ".join(command_line))
         found = 0
         result = []
 
         p = subprocess.Popen(command_line, stdout=subprocess.PIPE)
-        while found < len(filterids):
-            output = p.stdout.readline()
-            print output
-            if output == '' and p.poll() is not None:
+        for output in read_lines(p):
+            logging.debug("%s", output.rstrip())
+            try:
+                d = json.loads(output)
+                result.append(d)
+                found += 1
+            except ValueError as e:
+                print ("parse error")
+                continue
+            if found >= len(filterids):
                 break
-            if output:
-                try:
-                    d = json.loads(output)
-                    result.append(d)
-                    found += 1
-                except ValueError as e:
-                    print ("parse error")
-                    continue
-        else:
-            p.kill()
+        stop_process(p)
 
         return result
 
@@ -248,7 +171,7 @@ class rtl:
         " return current reading (in kwh) from meterid "
         if self.electric_meter_id == None:
             return None
-        d = self.__get_gas_and_electric_reading(None, self.electric_meter_id)
+        d = self.__get_meter_readings(None, self.electric_meter_id)
         return d["electric"]
 
     
@@ -256,45 +179,51 @@ class rtl:
         " return current reading (in ccf) from meterid "
         if self.gas_meter_id == None:
             return None
-        d = self.__get_gas_and_electric_reading(self.gas_meter_id, None)
+        d = self.__get_meter_readings(self.gas_meter_id, None)
         return d["gas"]
 
     def get_gas_and_electric_reading( self ):
         " return a dictionary with both gas and electric readings "
-        return self.__get_gas_and_electric_reading(self.gas_meter_id, self.electric_meter_id)
+        return self.__get_meter_readings(self.gas_meter_id, self.electric_meter_id)
+
+    def get_meter_readings( self, water=False ):
+        " return a dictionary with gas, electric and optionally water readings from a single rtlamr run "
+        if water:
+            return self.__get_meter_readings(self.gas_meter_id, self.electric_meter_id, self.water_meter_id)
+        return self.__get_meter_readings(self.gas_meter_id, self.electric_meter_id)
 
     
-    def __get_gas_and_electric_reading( self, gas_meter_id=None, electric_meter_id=None ):
-        " internal call: return dictionary with electric/gas readings "
+    def __get_meter_readings( self, gas_meter_id=None, electric_meter_id=None, water_meter_id=None ):
+        " internal call: return dictionary with electric/gas/water readings "
+        msgtypes = []
         ids = []
         if gas_meter_id:
             ids.append(str(gas_meter_id))
         if electric_meter_id:
             ids.append(str(electric_meter_id))
+        if len(ids) > 0:
+            msgtypes.append("scm")
+        if water_meter_id:
+            ids.append(str(water_meter_id))
+            msgtypes.append("r900bcd")
         if len(ids) == 0:
             return {}
-        l = self.get_rtl_values( "scm", ids )
+        l = self.get_rtl_values( ",".join(msgtypes), ids )
 
         d = {}
         for item in l:
-            if gas_meter_id and str(item["Message"]["ID"]) == str(gas_meter_id):
-                try:
-                    raw = item["Message"]["Consumption"]
-                    ccf = float(raw)/100.0
-                    d["gas"] = ccf
-                except KeyError as e:
-                    print ("Parse error, gas reading:", repr(d))
-                except ValueError as e:
-                    print ("Parse error, gas reading:", repr(d))
-            elif electric_meter_id and str(item["Message"]["ID"]) == str(electric_meter_id):
-                try:
-                    raw = item["Message"]["Consumption"]
-                    kwh = float(raw)/100.0
-                    d["electric"] = kwh
-                except KeyError as e:
-                    print ("Parse error, electric reading:", repr(d))
-                except ValueError as e:
-                    print ("Parse error, electric reading:", repr(d))
+            msg = item.get("Message", {})
+            # scm+ messages carry EndpointID instead of ID
+            kind = self._meter_kinds.get(msg.get("ID", msg.get("EndpointID")))
+            if kind is None:
+                continue
+            try:
+                # ccf, kwh and hcf are all reported in hundredths
+                d[kind] = float(msg["Consumption"])/100.0
+            except KeyError as e:
+                print ("Parse error, {0} reading:".format(kind), repr(item))
+            except ValueError as e:
+                print ("Parse error, {0} reading:".format(kind), repr(item))
         
         return d
     
@@ -303,83 +232,67 @@ class rtl:
         if self.water_meter_id == None:
             return None
         
-        d = self.get_rtl_values( "r900bcd", [ str(self.water_meter_id) ] )
-        try:
-            raw = d[0]["Message"]["Consumption"]
-            hcf = float(raw)/100.0
-        except IndexError as e:
+        d = self.__get_meter_readings(None, None, self.water_meter_id)
+        if "water" not in d:
             print ("No data returned")
             return None
-        except KeyError as e:
-            print ("Parse error", repr(d))
-            return None
-        except ValueError as e:
-            print ("parse error:", repr(d))
-            return None
 
-        return hcf
+        return d["water"]
     
 
 
 if __name__ == "__main__" :
 
     parser = argparse.ArgumentParser(description='DHT to influxdb service.')
-    parser.add_argument("--influx_server", dest='server', default='localhost', help='influxdb server')
-    parser.add_argument("--influx_port", dest='port', default=8086, help='influxdb server port number')
-    parser.add_argument("--influx_database", dest='db', default='pi_dht', help='influxdb database name')
-    parser.add_argument("--tags", dest='tags', default=None, help='influxdb tags in the form of name=value,name=value')
-    parser.add_argument("--interval", dest='interval', default=5, help='interval between readings in minutes')
+    add_influx_arguments(parser)
     parser.add_argument("--rtltcp_ip", dest='rtl_server_ip', default=None, help="ip address of rtltcp server")
     parser.add_argument("--rtltcp_port", dest='rtl_server_port', default=1234, help="port number of rtltcp server")
-    parser.add_argument("--water_id", dest='water_id', default=None, help="water meter id number")
-    parser.add_argument("--gas_id", dest='gas_id', default=None, help="gas meter id number")
-    parser.add_argument("--electric_id", dest='electric_id', default=None, help="electric meter id number")
+    parser.add_argument("--water_id", dest='water_id', type=int, default=None, help="water meter id number")
+    parser.add_argument("--gas_id", dest='gas_id', type=int, default=None, help="gas meter id number")
+    parser.add_argument("--electric_id", dest='electric_id', type=int, default=None, help="electric meter id number")
     parser.add_argument("--meter_db", dest='meter_db', default=None, help="influxdb name for meter readings")
+    parser.add_argument("--verbose", dest='verbose', action='store_true', help="log raw rtlamr output and the points written")
     hostname = socket.gethostname()
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
     
-    meter_client = None
+    meter_batcher = None
     r = None
+    # weather and meter readings go to the same server, so share one client
+    # (and its keep-alive connection) between them
+    print "Connecting to {0}:{1} and writing to database {2}".format(args.server, args.port, args.db)
+    client = InfluxDBClient(host=args.server, port=args.port, database=args.db, gzip=True)
+    weather_batcher = batch_writer(client, args)
+    atexit.register(weather_batcher.flush)
+
     if args.rtl_server_ip:
-        r = rtl(args.rtl_server_ip, args.rtl_server_port, args.electric_id, args.gas_id, args.water_id)
+        r = rtl(args.rtl_server_ip, args.rtl_server_port, args.electric_id, args.gas_id, args.water_id, {'hostname': hostname})
 
         if args.meter_db:
-            print "Connecting to {0}:{1} and writing to database {2}".format(args.server, args.port, args.meter_db)
-            meter_client = InfluxDBClient(host=args.server, port=args.port, database=args.meter_db)    
+            print "Writing meter readings to database {0}".format(args.meter_db)
+            meter_batcher = batch_writer(client, args, args.meter_db, weather_batcher.lock)
+            atexit.register(meter_batcher.flush)
 
-    weather_client = None
-    print "Connecting to {0}:{1} and writing to database {2}".format(args.server, args.port, args.db)
-    weather_client = InfluxDBClient(host=args.server, port=args.port, database=args.db)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     
-    tags = {'hostname': hostname}
-    if args.tags:
-        splits = args.tags.split(',')
-        for s in splits:
-            tag_split = s.split('=')
-            tags[tag_split[0]]=tag_split[1]
-        print "Found tags: {0}".format(repr(tags))
+    tags = parse_tags(hostname, args.tags)
 
     beat = 0 
     while True:
-        t1 = datetime.utcnow()
-        stamp = t1.isoformat()
+        t1 = time.time()
+        stamp = time_ns()
 
-        do_weather_reading(weather_client, stamp, tags )
+        output = do_weather_reading(weather_batcher, stamp, tags )
 
         if r:
-            r.do_gas_electric_meter_reading(meter_client, stamp, {'hostname': hostname} )
-            if (beat * int(args.interval)) % (6 * 60) == 0:
-                r.do_water_meter_reading(meter_client, stamp, {'hostname': hostname} )
-
-        t2 = datetime.utcnow()
-        td = t2 - t1        
-        sleeptime = int(args.interval)*60
-        if (sleeptime < td.total_seconds()):
-            sleeptime = 0
-        else:
-            sleeptime -= td.total_seconds()
-        print "Readings took {} seconds, sleeping {} seconds".format(td.total_seconds(), sleeptime)
+            water = (beat * int(args.interval)) % (6 * 60) == 0
+            output += r.do_meter_readings(meter_batcher, stamp, water )
+
+        elapsed = time.time() - t1
+        sleeptime = max(0, int(args.interval)*60 - elapsed)
+        output.append("Readings took {} seconds, sleeping {} seconds".format(elapsed, sleeptime))
+        write_output(output)
         time.sleep(sleeptime)
         beat += 1
         
@@ -0,0 +1,252 @@
+""" Helpers shared by the sensor to influxdb scripts """
+
+# Copyright (c) 2019  Jay Lubomirski
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import select
+import time
+import threading
+import collections
+from math import log
+
+from requests.exceptions import ConnectionError, Timeout
+from influxdb.exceptions import InfluxDBServerError
+
+def time_ns():
+    """ current time in integer nanoseconds since the epoch, for point timestamps """
+    return int(time.time() * 1e9)
+
+# dewpoint constants (see https://en.wikipedia.org/wiki/Dew_point)
+b = 17.27
+c = 237.7
+
+def gamma( Tc, RH ):
+    """ gamma function takes temperature in celcius and percent relative humidity """
+    return ( log(RH/100.0) + (b * Tc)/(c + Tc) )
+
+def dewpoint ( Tc, RH ):
+    """ calculate dewpoint in Celcius given temperature in celcius and relative humidity """
+    g = gamma(Tc, RH)
+    return ( (c * g) / (b - g) )
+
+def CtoF ( Tc ):
+    """ return Temperature in Farenheit """
+    return ( (Tc * (9.0/5.0)) + 32.0 )
+
+def weather_readings( temperatureC, humidity ):
+    """
+    Build the readings dictionary for a temperature in celcius and percent
+    relative humidity, adding farenheit and the dewpoint.
+    Returns None if the humidity is missing or not positive, since the
+    dewpoint can't be calculated for it
+    """
+    if humidity is None or humidity <= 0:
+        return None
+
+    dewpointC = dewpoint ( temperatureC, humidity )
+    temperatureF = CtoF(temperatureC)
+    dewpointF = CtoF(dewpointC)
+    
+    d = {}
+    d['tempC'] = temperatureC
+    d['tempF'] = temperatureF
+    d['rh'] = humidity
+    d['dewC'] = dewpointC
+    d['dewF'] = dewpointF
+    
+    return d
+
+def describe_readings( readings ):
+    """ return a one line summary of a readings dictionary """
+    return "Temp: {0}C {1}F, RH: {2}%, Dewpoint: {3}C {4}F".format( readings['tempC'], readings['tempF'], readings['rh'], readings['dewC'], readings['dewF'])
+
+def write_output( lines ):
+    """
+    Write an interval's output lines to stdout with a single write and flush,
+    rather than a print (and stdout lock) per line
+    """
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+def add_influx_arguments( parser ):
+    """ add the influxdb server, database, tags and interval options to an argparse parser """
+    parser.add_argument("--influx_server", dest='server', default='localhost', help='influxdb server')
+    parser.add_argument("--influx_port", dest='port', default=8086, help='influxdb server port number')
+    parser.add_argument("--influx_database", dest='db', default='pi_dht', help='influxdb database name')
+    parser.add_argument("--tags", dest='tags', default=None, help='influxdb tags in the form of name=value,name=value')
+    parser.add_argument("--interval", dest='interval', default=5, help='interval between readings in minutes')
+    parser.add_argument("--batch_intervals", dest='batch_intervals', default=1, help='number of intervals of readings to collect before writing them to influxdb')
+
+def parse_tags( hostname, tagstring ):
+    """ return the tags dictionary for hostname plus tags in the form of name=value,name=value """
+    tags = {'hostname': hostname}
+    if tagstring:
+        splits = tagstring.split(',')
+        for s in splits:
+            tag_split = s.split('=')
+            tags[tag_split[0]]=tag_split[1]
+        print "Found tags: {0}".format(repr(tags))
+    return tags
+
+def escape_tag( s ):
+    """ escape a tag key or value for influxdb line protocol (as influxdb-python does) """
+    return str(s).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=").replace("\n", "\\n")
+
+def to_lineprotocol( measurement, tags, fields, timestamp ):
+    """
+    Format a single point in influxdb line protocol.
+    Tags with an empty (or None) key or value are left out, field values are
+    written as floats, timestamp is in nanoseconds
+    """
+    tag_str = ""
+    for k, v in sorted(tags.items()):
+        if k is None or v is None:
+            continue
+        key = escape_tag(k)
+        value = escape_tag(v)
+        if key and value:
+            tag_str += ",{0}={1}".format(key, value)
+    field_str = ",".join(["{0}={1!r}".format(k, float(v)) for k, v in sorted(fields.items())])
+    return "{0}{1} {2} {3}".format(measurement, tag_str, field_str, timestamp)
+
+def build_series( readings, tags, timestamp ):
+    """ return the temperature, humidity and dewpoint points for a readings dictionary """
+    return [
+        to_lineprotocol("temperature", tags, { "tempF": readings['tempF'], "tempC": readings['tempC'] }, timestamp),
+        to_lineprotocol("humidity", tags, { "rh": readings['rh'] }, timestamp),
+        to_lineprotocol("dewpoint", tags, { "dewF": readings['dewF'], "dewC": readings['dewC'] }, timestamp)
+        ]
+
+class BatchWriter:
+    """
+    Queue points in memory and write them to influxdb in batches.
+    A batch is written once max_points are queued or the oldest queued
+    point is max_age seconds old. database overrides the client's default
+    database, so several writers can share one client and its connection;
+    writers sharing a client must also share a lock so their writes don't
+    overlap on its session.
+    At most max_queued points are held while the server is unreachable;
+    beyond that the oldest are dropped.
+    """
+
+    def __init__ ( self, client, database=None, max_points=5000, max_age=60, max_queued=50000, lock=None ):
+        self.client = client
+        self.database = database
+        self.max_points = max_points
+        self.max_age = max_age
+        self.buffer = collections.deque(maxlen=max_queued)
+        self.oldest = None
+        self.lock = lock if lock is not None else threading.Lock()
+
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def append( self, series ):
+        " queue a list of points, writing the batch if it is full "
+        with self.lock:
+            if self.oldest is None:
+                self.oldest = time.time()
+            self.buffer.extend(series)
+            full = len(self.buffer) >= self.max_points
+        if full:
+            self.flush()
+
+    def flush( self ):
+        """
+        write all queued points. If the server can't be reached (or fails
+        with a 5xx) they stay queued for the next try; any other error means
+        the server rejected the batch, so it is dropped rather than retried
+        """
+        with self.lock:
+            if not self.buffer:
+                return
+            points = list(self.buffer)
+            try:
+                self.client.write_points(points, database=self.database, batch_size=self.max_points, protocol='line')
+            except (ConnectionError, Timeout, InfluxDBServerError) as e:
+                print "Failed to write {0} points, will retry: {1}".format(len(points), e)
+                self.oldest = time.time()
+                return
+            except Exception as e:
+                print "Dropping {0} points rejected by influxdb: {1}".format(len(points), e)
+            self.buffer.clear()
+            self.oldest = None
+
+    def run( self ):
+        " background thread: write the batch once the oldest point is max_age seconds old "
+        while True:
+            time.sleep(1)
+            oldest = self.oldest
+            if oldest is not None and time.time() - oldest >= self.max_age:
+                self.flush()
+
+
+def batch_writer( client, args, database=None, lock=None ):
+    """
+    return a BatchWriter that writes once --batch_intervals intervals of readings
+    are queued: the batch is flushed a minute after the last of them arrives
+    """
+    max_age = (int(args.batch_intervals) - 1) * int(args.interval) * 60 + 60
+    return BatchWriter(client, database, max_age=max_age, lock=lock)
+
+
+def read_lines( p, timeout=5.0 ):
+    """
+    Yield complete, non-empty lines from the stdout of subprocess p until it exits.
+    Waits on the pipe with poll() and reads whatever is available at once
+    straight from the fd (so Popen's bufsize has no effect here), only
+    checking whether p has exited when nothing arrives for timeout seconds
+    """
+    fd = p.stdout.fileno()
+    poller = select.poll()
+    poller.register(fd, select.POLLIN)
+    pending = b''
+    while True:
+        if not poller.poll(timeout * 1000):
+            if p.poll() is not None:
+                break
+            continue
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if pending:
+        yield pending
+
+def stop_process( p, timeout=2.0 ):
+    """
+    Ask subprocess p to exit with SIGTERM so it can release the radio cleanly,
+    killing it if it is still running after timeout seconds
+    """
+    if p.poll() is None:
+        p.terminate()
+        deadline = time.time() + timeout
+        while p.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if p.poll() is None:
+            p.kill()
+    p.wait()